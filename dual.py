@@ -6,7 +6,22 @@ Created on Thu Dec  8 19:05:38 2022
 """
 
 from dataclasses import dataclass
+import heapq
 import math
+import operator
+import time
+
+
+# sum() is left out so that `from dual import *` does not replace the
+# builtin; use dual.sum
+__all__ = [
+    'Dual', 'as_dual',
+    'sin', 'asin', 'cos', 'acos', 'tan', 'atan', 'sinh', 'cosh', 'tanh',
+    'exp', 'expm1', 'log', 'log10', 'log1p', 'log2', 'cbrt', 'hypot', 'sqrt',
+    'dot', 'prod', 'polyval', 'near_eq',
+    'LeastSquaresIteration', 'LeastSquaresResult', 'least_squares',
+    'fixed_point', 'implicit_root', 'Recording',
+]
 
 
 # try/except blocks test faster than isinstance for simple expressions
@@ -16,6 +31,21 @@ import math
 # so I use real as the real part of the dual number. This has the additional
 # advantage of duck typing in some of the operators working
 
+# largest |n| for which x**n is computed by repeated multiplication
+_MAX_INT_POW = 32
+
+
+def _ipow(a, m):
+    """Return a**m for integer m >= 0 by repeated squaring."""
+    p = 1.
+    while m:
+        if m & 1:
+            p = p * a
+        m >>= 1
+        if m:
+            a = a * a
+    return p
+
 @dataclass
 class Dual:
     real : float       # real part
@@ -66,7 +96,7 @@ class Dual:
         except AttributeError:
             return self.real == y
 
-    def __pow__(self, y):
+    def __pow__(x, y):
         """ x**y """
 
         # this is tricky
@@ -80,28 +110,89 @@ class Dual:
         # x < 0, y integer, dy != 0 derivatives are not finite
         # x < 0, y noninteger: neither value or derivative is finite
 
-        if not isinstance(y, Dual):
-            y = Dual(y, 0)
+        # Fast paths, tried in order:
+        #   * y is the int 2 or 3, the powers cost functions use most.
+        #   * small integer y with dy == 0: repeated multiplication. The
+        #     derivative n x^(n-1) comes from the same product chain, and only
+        #     * and / are used, so array valued real/dual parts work too.
+        #   * constant y (dy == 0): x^y and y x^y / x, no log term.
+        #   * dual y: the general rule above.
 
-        if self.real == 0 and y.real >= 1:
-            if y.real > 1:
-                return Dual(0,0);
-            else:
-                return self;
-
-        if self.real < 0 and y == math.floor(y.real):
-            tmp = y.real * math.pow(self.real, y.real - 1)
-            return Dual(math.pow(self.real, y.real), tmp * self.dual)
+        a = x.real
+        if y.__class__ is int:
+            if y == 2:
+                r = a * a
+                if r.__class__ is float and r - r != 0 and a - a == 0:
+                    raise OverflowError('math range error')
+                return Dual(r, 2 * a * x.dual)
+            if y == 3:
+                aa = a * a
+                r = aa * a
+                if r.__class__ is float and r - r != 0 and a - a == 0:
+                    raise OverflowError('math range error')
+                return Dual(r, 3 * aa * x.dual)
+            y_real, y_dual = y, 0
+        elif isinstance(y, Dual):
+            y_real, y_dual = y.real, y.dual
         else:
-            tmp1 = math.pow(self.real, y.real)
-            tmp2 = y.real * math.pow(self.real, y.real - 1)
-            tmp3 = tmp1 * math.log(self.real)
-            return Dual(tmp1, tmp2 * self.dual + tmp3 * y.dual)
+            y_real, y_dual = y, 0
+
+        if y_dual == 0:
+            if -_MAX_INT_POW <= y_real <= _MAX_INT_POW and y_real == int(y_real):
+                n = int(y_real)
+                if n == 1:
+                    return Dual(a, x.dual)
+                if n == 0:
+                    if isinstance(a, (int, float)):
+                        if a == 0:
+                            raise ValueError('math domain error')
+                        return Dual(1., 0. * x.dual)
+                    return Dual(a * 0 + 1, x.dual * 0)
+                if n > 0:
+                    # a**(n-1), with n = 2..4 written out
+                    if n == 2:
+                        p = a
+                    elif n == 3:
+                        p = a * a
+                    elif n == 4:
+                        p = a * a * a
+                    else:
+                        p = _ipow(a, n - 1)
+                    r = p * a
+                    # math.pow raises when a finite base overflows, and so do we
+                    if r.__class__ is float and r - r != 0 and a - a == 0:
+                        raise OverflowError('math range error')
+                    return Dual(r, n * p * x.dual)
+
+                p = _ipow(a, -n - 1)
+                try:
+                    inv = 1. / (p * a)
+                except ZeroDivisionError:
+                    if a == 0:
+                        raise ValueError('math domain error') from None
+                    raise OverflowError('math range error') from None
+                return Dual(inv, n * inv / a * x.dual)
+
+            tmp = math.pow(a, y_real)
+            if a != 0:
+                return Dual(tmp, y_real * tmp / a * x.dual)
+
+        if a == 0:
+            if y_real > 1:
+                return Dual(0, 0)
+            if y_real == 1:
+                return x
+            raise ValueError('math domain error')
+
+        tmp = math.pow(a, y_real)
+        if a < 0 and y_real == math.floor(y_real):
+            return Dual(tmp, y_real * tmp / a * x.dual)
+        return Dual(tmp, (y_real * x.dual / a + math.log(a) * y_dual) * tmp)
 
     def __rpow__(self, y):
         # y**x, if expression is 3 ** Dual(4),then x = Dual(4), y = 3
         real = y ** self.real
-        return Dual(real, real*(self.dual * math.log(y.real)))
+        return Dual(real, real * self.dual * math.log(y))
 
     def __truediv__(self, y):
         y_real_inv = 1. / y.real
@@ -137,7 +228,10 @@ def sin(x):
         a = x.real
         return Dual(math.sin(a), math.cos(a)*x.dual)
     else:
-        return math.sin(x)
+        try:
+            return math.sin(x)
+        except TypeError:
+            return _record(sin, x)
 
 def asin(x):
     """Return the arc sine (measured in radians) of x."""
@@ -146,7 +240,10 @@ def asin(x):
         a = x.real
         return Dual(math.asin(a), x.dual / math.sqrt(1 - a*a))
     else:
-        return math.asin(x)
+        try:
+            return math.asin(x)
+        except TypeError:
+            return _record(asin, x)
 
 def cos(x):
     """Return the cosine of x (measured in radians)."""
@@ -156,7 +253,10 @@ def cos(x):
         a = x.real
         return Dual(math.cos(a), -math.sin(a)*x.dual)
     else:
-        return math.cos(x)
+        try:
+            return math.cos(x)
+        except TypeError:
+            return _record(cos, x)
 
 def acos(x):
     """Return the arc cosine (measured in radians) of x."""
@@ -165,7 +265,10 @@ def acos(x):
         a = x.real
         return Dual(math.acos(a), x.dual / math.sqrt(1 - a*a))
     else:
-        return math.acos(x)
+        try:
+            return math.acos(x)
+        except TypeError:
+            return _record(acos, x)
 
 def tan(x):
     """Return the tangent of x (measured in radians)."""
@@ -174,7 +277,10 @@ def tan(x):
         tana = math.tan(x.real)
         return Dual(tana, x.dual * (1 + tana*tana))
     else:
-        return math.tan(x)
+        try:
+            return math.tan(x)
+        except TypeError:
+            return _record(tan, x)
 
 def atan(x):
     """Return the arc tangent (measured in radians) of x."""
@@ -185,7 +291,10 @@ def atan(x):
         atana = math.atan(a)
         return Dual(atana, x.dual / (1 + a*a))
     else:
-        return math.atan(x)
+        try:
+            return math.atan(x)
+        except TypeError:
+            return _record(atan, x)
 
 
 def sinh(x):
@@ -195,7 +304,10 @@ def sinh(x):
         a = x.real
         return Dual(math.sinh(a), math.cosh(a)*x.dual)
     else:
-        return math.sinh(x)
+        try:
+            return math.sinh(x)
+        except TypeError:
+            return _record(sinh, x)
 
 
 def cosh(x):
@@ -206,7 +318,10 @@ def cosh(x):
            a = x.real
            return Dual(math.cosh(a), math.sinh(a)*x.dual)
        else:
-           return math.cos(x)
+           try:
+               return math.cos(x)
+           except TypeError:
+               return _record(cosh, x)
 
 
 def tanh(x):
@@ -216,7 +331,10 @@ def tanh(x):
         tana = math.tan(x.real)
         return Dual(tana, x.dual * (1 + tana*tana))
     else:
-        return math.tan(x)
+        try:
+            return math.tan(x)
+        except TypeError:
+            return _record(tanh, x)
 
 
 def exp(x):
@@ -230,7 +348,10 @@ def exp(x):
             raise OverflowError
         return Dual(e, e*x.dual)
     else:
-        return math.exp(x)
+        try:
+            return math.exp(x)
+        except TypeError:
+            return _record(exp, x)
 
 
 def expm1(x):
@@ -245,7 +366,10 @@ def expm1(x):
         em1 = math.expm1(x.real)
         return Dual(em1, (1+em1)*x.dual)
     else:
-        return math.expm1(x)
+        try:
+            return math.expm1(x)
+        except TypeError:
+            return _record(expm1, x)
 
 
 def log(x):
@@ -253,7 +377,10 @@ def log(x):
     if isinstance(x, Dual):
         return Dual(math.log(x.real), x.dual / x.real)
     else:
-        return math.log(x)
+        try:
+            return math.log(x)
+        except TypeError:
+            return _record(log, x)
 
 
 def log10(x):
@@ -264,7 +391,10 @@ def log10(x):
         # log(10) == 2.3025850929940459
         return Dual(math.log10(x.real), x.dual / 2.3025850929940459)
     else:
-        return math.log10(x)
+        try:
+            return math.log10(x)
+        except TypeError:
+            return _record(log10, x)
 
 def log1p(x):
     """Return the natural logarithm of 1+x (base e)."""
@@ -274,7 +404,10 @@ def log1p(x):
         # log(10) == 2.3025850929940459
         return Dual(math.log10(x.real), x.dual / (1. + x.real))
     else:
-        return math.log1p(x)
+        try:
+            return math.log1p(x)
+        except TypeError:
+            return _record(log1p, x)
 
 def log2(x):
     """Return the base 2 logarithm of x."""
@@ -285,7 +418,10 @@ def log2(x):
         real = x.real
         return Dual(math.log2(real), x.dual / (real * 0.693147180559945286))
     else:
-        return math.log2(x)
+        try:
+            return math.log2(x)
+        except TypeError:
+            return _record(log2, x)
 
 
 def cbrt(x):
@@ -295,6 +431,11 @@ def cbrt(x):
         real = x.real
         cr = math.pow(real, 1./3)
         return Dual(cr, x.dual / (3 * cr * cr))
+    else:
+        try:
+            return math.pow(x, 1./3)
+        except TypeError:
+            return _record(cbrt, x)
 
 
 def hypot(x, y):
@@ -313,7 +454,10 @@ def hypot(x, y):
         h = math.hypot(x.real, y.real)
         return Dual(h, (x.real * x.dual + y.real * y.dual) / h)
     else:
-        return math.hypot(x, y)
+        try:
+            return math.hypot(x, y)
+        except TypeError:
+            return _record(hypot, x, y)
 
 
 def sqrt(x):
@@ -323,7 +467,149 @@ def sqrt(x):
         tmp = math.sqrt(x.real)
         return Dual(tmp, x.dual / (2. * tmp))
     else:
-        return math.sqrt(x)
+        try:
+            return math.sqrt(x)
+        except TypeError:
+            return _record(sqrt, x)
+
+
+def sum(xs, *, compensated=False):
+    """Return the sum of the Duals (and numbers) in xs as a single Dual.
+
+    The real and dual parts are accumulated separately, so no intermediate
+    Duals are created. If compensated is True both parts are summed with
+    math.fsum, which is slower but does not lose precision.
+    """
+    xs = iter(xs)
+    if compensated:
+        reals = []
+        duals = []
+        for x in xs:
+            try:
+                reals.append(x.real)
+            except TypeError:
+                done = [Dual(r, d) for r, d in zip(reals, duals)]
+                return _record(_sum_of, True, *done, x, *xs)
+            duals.append(getattr(x, 'dual', 0.))
+        return Dual(math.fsum(reals), math.fsum(duals))
+
+    real = 0.
+    dual = 0.
+    for x in xs:
+        try:
+            real += x.real
+        except TypeError:
+            return _record(_sum_of, False, Dual(real, dual), x, *xs)
+        try:
+            dual += x.dual
+        except AttributeError:
+            pass
+    return Dual(real, dual)
+
+
+def dot(xs, ys, *, compensated=False):
+    """Return the dot product sum(x*y for x, y in zip(xs, ys)) as a single
+    Dual. Elements of either sequence may be Duals or numbers.
+
+    If compensated is True the terms are summed with math.fsum.
+    """
+    pairs = zip(xs, ys)
+    if compensated:
+        reals = []
+        duals = []
+        for x, y in pairs:
+            try:
+                xr, xd = x.real, getattr(x, 'dual', 0.)
+                yr, yd = y.real, getattr(y, 'dual', 0.)
+            except TypeError:
+                done = Dual(math.fsum(reals), math.fsum(duals))
+                return _record_dot(True, done, x, y, pairs)
+            reals.append(xr * yr)
+            duals.append(xr * yd)
+            duals.append(xd * yr)
+        return Dual(math.fsum(reals), math.fsum(duals))
+
+    real = 0.
+    dual = 0.
+    for x, y in pairs:
+        try:
+            xr, xd = x.real, getattr(x, 'dual', 0.)
+            yr, yd = y.real, getattr(y, 'dual', 0.)
+        except TypeError:
+            return _record_dot(False, Dual(real, dual), x, y, pairs)
+        real += xr * yr
+        dual += xr * yd + xd * yr
+    return Dual(real, dual)
+
+
+def prod(xs):
+    """Return the product of the Duals (and numbers) in xs as a single Dual."""
+    xs = iter(xs)
+    real = 1.
+    dual = 0.
+    for x in xs:
+        # (r + d h)(xr + xd h) ~= r xr + (d xr + r xd) h
+        try:
+            xr = x.real
+        except TypeError:
+            return _record(_prod_of, Dual(real, dual), x, *xs)
+        dual = dual * xr + real * getattr(x, 'dual', 0.)
+        real = real * xr
+    return Dual(real, dual)
+
+
+def polyval(p, x):
+    """Evaluate the polynomial with coefficients p (highest power first, as
+    in numpy.polyval) at x using Horner's scheme.
+
+    With x = Dual(a, 1) the result is Dual(p(a), p'(a)). The coefficients
+    may themselves be Duals.
+    """
+    p = iter(p)
+    try:
+        xr, xd = x.real, getattr(x, 'dual', 0.)
+    except TypeError:
+        return _record(_polyval_of, x, *p)
+    real = 0.
+    dual = 0.
+    for c in p:
+        # (r + d h)(xr + xd h) + c
+        try:
+            cd = getattr(c, 'dual', 0.)
+        except TypeError:
+            # Horner's scheme carries on from the value so far as the
+            # leading coefficient
+            return _record(_polyval_of, x, Dual(real, dual), c, *p)
+        dual = dual * xr + real * xd + cd
+        real = real * xr + c.real
+    return Dual(real, dual)
+
+
+# The reductions hand what is left of their input to these when they meet a
+# value traced by a Recording, which records the rest as a single node. The
+# items already consumed are constants, folded into the first argument.
+
+def _sum_of(compensated, *xs):
+    return sum(xs, compensated=compensated)
+
+
+def _record_dot(compensated, done, x, y, pairs):
+    rest = [(x, y), *pairs]
+    return _record(_dot_of, compensated, done,
+                   *[a for a, _ in rest], *[b for _, b in rest])
+
+
+def _dot_of(compensated, done, *xy):
+    n = len(xy) // 2
+    return done + dot(xy[:n], xy[n:], compensated=compensated)
+
+
+def _prod_of(*xs):
+    return prod(xs)
+
+
+def _polyval_of(x, *p):
+    return polyval(p, x)
 
 
 def near_eq(x:Dual, y:Dual, eps: float = 1e-12):
@@ -334,3 +620,560 @@ def near_eq(x:Dual, y:Dual, eps: float = 1e-12):
     diff = x - y
     return abs(diff.real) <= eps and abs(diff.dual) <= eps
 
+
+
+def _solve(A, b):
+    """Solve A x = b in place by Gaussian elimination with partial pivoting,
+    and return b, which now holds x. A is a list of rows and is overwritten.
+    Raises ZeroDivisionError if A is singular."""
+    n = len(b)
+    for i in range(n):
+        p = max(range(i, n), key=lambda k: abs(A[k][i]))
+        if p != i:
+            A[i], A[p] = A[p], A[i]
+            b[i], b[p] = b[p], b[i]
+        Ai = A[i]
+        inv = 1. / Ai[i]
+        for k in range(i + 1, n):
+            Ak = A[k]
+            f = Ak[i] * inv
+            if f:
+                for j in range(i + 1, n):
+                    Ak[j] -= f * Ai[j]
+                b[k] -= f * b[i]
+    for i in range(n - 1, -1, -1):
+        Ai = A[i]
+        b[i] = (b[i] - math.fsum(Ai[j] * b[j] for j in range(i + 1, n))) / Ai[i]
+    return b
+
+
+def _color_columns(sparsity, n):
+    """Greedily group the n Jacobian columns so that no two columns in a
+    group share a residual. sparsity[k] lists the columns residual k depends
+    on. Returns the groups and, for each group, the column each residual
+    depends on in that group (-1 for none)."""
+    rows_of = [[] for _ in range(n)]
+    for k, cols in enumerate(sparsity):
+        for j in cols:
+            rows_of[j].append(k)
+
+    color = [-1] * n
+    for j in range(n):
+        taken = {color[i] for k in rows_of[j] for i in sparsity[k] if i != j}
+        c = 0
+        while c in taken:
+            c += 1
+        color[j] = c
+
+    groups = [[] for _ in range(max(color, default=-1) + 1)]
+    owner = [[-1] * len(sparsity) for _ in groups]
+    for j in range(n):
+        groups[color[j]].append(j)
+        for k in rows_of[j]:
+            owner[color[j]][k] = j
+    return groups, owner
+
+
+@dataclass
+class LeastSquaresIteration:
+    cost : float         # 0.5 * sum of squared residuals after the iteration
+    damping : float      # Levenberg-Marquardt lambda of the accepted step
+    evaluations : int    # calls of the residual function in the iteration
+    seconds : float      # wall time of the iteration
+
+
+@dataclass
+class LeastSquaresResult:
+    x : list             # parameters at the solution
+    cost : float         # 0.5 * sum of squared residuals at x
+    residuals : list     # residuals at x
+    jacobian : list      # Jacobian of the residuals at x, one list per residual
+    converged : bool     # True if the gtol, xtol or ftol test passed
+    message : str        # why the iteration stopped
+    evaluations : int    # total calls of the residual function
+    history : list       # a LeastSquaresIteration per iteration
+
+
+def least_squares(residuals, x0, sparsity=None, damping=1e-3, max_iter=100,
+                  ftol=1e-12, xtol=1e-12, gtol=1e-12):
+    """Minimize 0.5 * sum(r**2 for r in residuals(x)) over the parameters x
+    by Gauss-Newton steps with Levenberg-Marquardt damping.
+
+    residuals(x) is called with a list of Duals, one per parameter, and
+    returns a sequence of residuals written with the operators and functions
+    in this module. Each call seeds the dual parts of some parameters with 1
+    and fills the matching Jacobian columns, so a dense problem takes one
+    call per parameter to build the Jacobian.
+
+    sparsity optionally lists, for each residual, the positions of the
+    parameters it depends on. Parameters that share no residual are then
+    seeded in the same call, which for banded or block structured problems
+    needs far fewer calls than there are parameters.
+
+    The parameter Duals, Jacobian and normal equations are allocated once
+    and reused, so residuals() must not keep references to its argument.
+    Iteration stops when the gradient, the step or the relative decrease in
+    cost falls below gtol, xtol or ftol, which sets converged. It also
+    stops, with converged False, after max_iter iterations or when no
+    damping gives a step that decreases the cost; message says which.
+    """
+    perf_counter = time.perf_counter
+    n = len(x0)
+    x = [float(v) for v in x0]
+    params = [Dual(v, 0.) for v in x]
+    evaluations = 0
+
+    def values(x):
+        nonlocal evaluations
+        for p, v in zip(params, x):
+            p.real = v
+            p.dual = 0.
+        evaluations += 1
+        return [r.real for r in residuals(params)]
+
+    r = values(x)
+    m = len(r)
+    cost = 0.5 * math.fsum(v * v for v in r)
+
+    if sparsity is None:
+        groups = [[j] for j in range(n)]
+        owner = None
+        nonzero = [range(n)] * m
+    else:
+        if len(sparsity) != m:
+            raise ValueError(f'sparsity has {len(sparsity)} rows, '
+                             f'but there are {m} residuals')
+        groups, owner = _color_columns(sparsity, n)
+        nonzero = [sorted(set(cols)) for cols in sparsity]
+
+    J = [[0.] * n for _ in range(m)]
+    A = [[0.] * n for _ in range(n)]
+    M = [[0.] * n for _ in range(n)]
+    g = [0.] * n
+
+    def jacobian(x):
+        nonlocal evaluations
+        for p, v in zip(params, x):
+            p.real = v
+        for c, cols in enumerate(groups):
+            for p in params:
+                p.dual = 0.
+            for j in cols:
+                params[j].dual = 1.
+            evaluations += 1
+            for k, rk in enumerate(residuals(params)):
+                j = cols[0] if owner is None else owner[c][k]
+                if j >= 0:
+                    J[k][j] = getattr(rk, 'dual', 0.)
+
+    jacobian(x)
+    lam = damping
+    history = []
+    converged = False
+    message = f'max_iter ({max_iter}) reached'
+    for _ in range(max_iter):
+        t0 = perf_counter()
+        evaluations0 = evaluations
+
+        # normal equations A = J^T J, g = J^T r
+        for i in range(n):
+            A[i][:] = [0.] * n
+            g[i] = 0.
+        for k in range(m):
+            Jk, rk = J[k], r[k]
+            for i in nonzero[k]:
+                Jki = Jk[i]
+                if Jki:
+                    g[i] += Jki * rk
+                    Ai = A[i]
+                    for j in nonzero[k]:
+                        Ai[j] += Jki * Jk[j]
+
+        if max(map(abs, g), default=0.) <= gtol:
+            converged = True
+            message = 'gradient below gtol'
+            break
+
+        accepted = False
+        while True:
+            for i in range(n):
+                M[i][:] = A[i]
+                M[i][i] += lam * (A[i][i] or 1.)
+            try:
+                step = _solve(M, [-v for v in g])
+            except ZeroDivisionError:
+                step = None
+            if step is not None:
+                x_new = [v + s for v, s in zip(x, step)]
+                r_new = values(x_new)
+                cost_new = 0.5 * math.fsum(v * v for v in r_new)
+                accepted = cost_new < cost
+                if accepted:
+                    break
+            if lam > 1e16:
+                break
+            lam *= 10.
+
+        if not accepted:
+            # no damping decreases the cost. That happens at a minimum the
+            # tolerances are too tight for, but also where the Gauss-Newton
+            # model is useless (e.g. a kink), so it is not convergence
+            history.append(LeastSquaresIteration(
+                cost, lam, evaluations - evaluations0, perf_counter() - t0))
+            message = 'damping stalled, no step decreases the cost'
+            break
+
+        small_step = (math.sqrt(math.fsum(s * s for s in step)) <=
+                      xtol * (math.sqrt(math.fsum(v * v for v in x)) + xtol))
+        small_decrease = cost - cost_new <= ftol * cost
+        x, r, cost = x_new, r_new, cost_new
+        jacobian(x)
+        history.append(LeastSquaresIteration(
+            cost, lam, evaluations - evaluations0, perf_counter() - t0))
+        lam = max(lam * 0.1, 1e-15)
+
+        if small_step or small_decrease:
+            converged = True
+            message = 'step below xtol' if small_step else 'cost decrease below ftol'
+            break
+
+    return LeastSquaresResult(x, cost, r, [row[:] for row in J], converged,
+                              message, evaluations, history)
+
+
+def _real_parts(params):
+    if isinstance(params, (list, tuple)):
+        return type(params)(p.real for p in params)
+    return params.real
+
+
+def _as_vector_function(f, x0):
+    """Return x0 as a list of floats and f(x, params) wrapped to take and
+    return lists, plus whether x0 was a scalar."""
+    if isinstance(x0, (list, tuple)):
+        return [float(v.real) for v in x0], lambda x, p: list(f(x, p)), False
+    return [float(x0.real)], lambda x, p: [f(x[0], p)], True
+
+
+def _jacobian(F, x, params):
+    """Return F(x, params) and its Jacobian with respect to x, using one
+    Dual evaluation of F per component of x."""
+    n = len(x)
+    xs = [Dual(v, 0.) for v in x]
+    f = J = None
+    for j in range(n):
+        xs[j].dual = 1.
+        out = F(xs, params)
+        xs[j].dual = 0.
+        if J is None:
+            f = [v.real for v in out]
+            J = [[0.] * n for _ in out]
+        for i, v in enumerate(out):
+            J[i][j] = getattr(v, 'dual', 0.)
+    return f, J
+
+
+def _implicit_tangent(F, x, params, J, scalar):
+    """x solves F(x, params) = 0 and J is dF/dx there. Return x as Duals
+    whose dual parts are dx = -J^-1 dF/dparams dparams, from a single Dual
+    evaluation of F."""
+    dual_params = params if isinstance(params, (list, tuple)) else [params]
+    if any(getattr(p, 'dual', 0.) for p in dual_params):
+        out = F([Dual(v, 0.) for v in x], params)
+        dx = _solve(J, [-getattr(v, 'dual', 0.) for v in out])
+    else:
+        dx = [0.] * len(x)
+
+    result = [Dual(v, d) for v, d in zip(x, dx)]
+    return result[0] if scalar else result
+
+
+def fixed_point(g, x0, params, tol=1e-12, max_iter=1000):
+    """Return the fixed point x = g(x, params), iterating from x0, with dual
+    parts giving its derivative along the tangent carried by params.
+
+    The iteration runs on real numbers only. The derivative then comes from
+    the implicit function theorem, (I - dg/dx) dx = dg/dparams dparams,
+    which costs one Dual evaluation of g per component of x plus one more,
+    however many iterations the solve took. Propagating Duals through the
+    iteration instead multiplies the cost by the iteration count.
+
+    x0 is a number or a list of numbers, and g(x, params) returns the same.
+    params is a number, Dual, or a list of them, passed through to g.
+    Raises RuntimeError if the iteration has not converged after max_iter
+    steps.
+    """
+    x, G, scalar = _as_vector_function(g, x0)
+    p = _real_parts(params)
+    for _ in range(max_iter):
+        x_new = [v.real for v in G(x, p)]
+        delta = max(abs(a - b) for a, b in zip(x_new, x))
+        x = x_new
+        if delta <= tol * (1. + max(map(abs, x))):
+            break
+    else:
+        raise RuntimeError(f'fixed point iteration did not converge in {max_iter} steps')
+
+    def F(x, p):
+        return [a - b for a, b in zip(G(x, p), x)]
+
+    _, J = _jacobian(F, x, p)
+    return _implicit_tangent(F, x, params, J, scalar)
+
+
+def implicit_root(F, x0, params, tol=1e-12, max_iter=50):
+    """Return the root of F(x, params) = 0 found by Newton's method from x0,
+    with dual parts giving its derivative along the tangent carried by
+    params.
+
+    Newton's method runs on the real parts of params, and the derivative of
+    the root comes from the implicit function theorem,
+    dF/dx dx = -dF/dparams dparams, at the cost of one extra Dual evaluation
+    of F however many Newton steps were taken.
+
+    x0 is a number or a list of numbers, and F(x, params) returns the same.
+    params is a number, Dual, or a list of them, passed through to F.
+    Raises RuntimeError if Newton's method has not converged after max_iter
+    steps.
+    """
+    x, F, scalar = _as_vector_function(F, x0)
+    p = _real_parts(params)
+    small_step = False
+    # max_iter steps, with the residual checked before each and after the last
+    for i in range(max_iter + 1):
+        f, J = _jacobian(F, x, p)
+        if small_step or max(map(abs, f)) <= tol:
+            break
+        if i == max_iter:
+            raise RuntimeError(f'Newton iteration did not converge in {max_iter} steps')
+        step = _solve(J, [-v for v in f])
+        x = [a + s for a, s in zip(x, step)]
+        small_step = max(map(abs, step)) <= tol * (1. + max(map(abs, x)))
+
+    return _implicit_tangent(F, x, params, J, scalar)
+
+
+class Recording:
+    """Records one evaluation of f(*inputs) so that it can be re-evaluated
+    cheaply when only some of the inputs change.
+
+    f is called once with stand-ins for the inputs, and every arithmetic
+    operator and function from this module applied to them becomes a node
+    of a graph that keeps its current Dual value. update() then recomputes
+    only the nodes downstream of the inputs that changed, and stops early
+    wherever a recomputed value comes out unchanged.
+
+    The inputs may be Duals or numbers (numbers get a zero dual part). f must
+    build its result from its arguments and plain numbers only: control flow
+    that depends on the inputs is not recorded, and comparisons, truth tests,
+    a Dual constant on the left of an operator or passed to hypot() all
+    raise TypeError. The reductions sum(), dot(), prod() and polyval() are
+    recorded as a single node each. f may return a single
+    value or a tuple or list of them.
+
+    >>> rec = Recording(lambda x, y: x*x + sin(y), Dual(3, 1), 2.)
+    >>> r = rec.update({1: 2.5})  # only sin(y) and the sum are recomputed
+    >>> rec.recomputed
+    2
+    """
+
+    def __init__(self, f, *inputs):
+        self._fns = []       # function of each node, None for inputs
+        self._args = []      # arguments of each node, _Traced for other nodes
+        self._values = []    # current Dual value of each node
+        self._children = []  # indices of the nodes that use each node
+
+        self.n_inputs = len(inputs)
+        traced = [self._apply(None, as_dual(x)) for x in inputs]
+        self._output = f(*traced)
+
+        # number of nodes recomputed by the last update()
+        self.recomputed = len(self._values) - self.n_inputs
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def inputs(self):
+        """Current values of the inputs."""
+        return self._values[:self.n_inputs]
+
+    @property
+    def result(self):
+        """Current value of f(*inputs)."""
+        out = self._output
+        if isinstance(out, (tuple, list)):
+            return type(out)(self._value_of(o) for o in out)
+        return self._value_of(out)
+
+    def update(self, changes):
+        """Change some of the inputs and re-evaluate f, recomputing only the
+        nodes that depend on them. Return the new result.
+
+        changes maps input position to the new value. A Dual replaces the
+        input, a number replaces its real part and keeps its dual part.
+        """
+        values = self._values
+        dirty = []
+        for i, x in changes.items():
+            if not 0 <= i < self.n_inputs:
+                raise IndexError(f'input {i} out of range')
+            old = values[i]
+            new = Dual(x.real, getattr(x, 'dual', old.dual))
+            if new != old:
+                values[i] = new
+                dirty.extend(self._children[i])
+        self._propagate(dirty)
+        return self.result
+
+    def seed(self, direction):
+        """Set the dual parts of the inputs and re-evaluate f. direction is
+        either the position of a single input, which gets dual part 1 while
+        all others get 0, or a sequence with one dual part per input.
+        Return the new result.
+        """
+        n = self.n_inputs
+        if isinstance(direction, int):
+            if not 0 <= direction < n:
+                raise IndexError(f'input {direction} out of range')
+            tangent = [0.] * n
+            tangent[direction] = 1.
+        else:
+            tangent = list(direction)
+            if len(tangent) != n:
+                raise ValueError(f'expected {n} dual parts, got {len(tangent)}')
+
+        values = self._values
+        return self.update({i: Dual(values[i].real, tangent[i])
+                            for i in range(n)})
+
+    def _value_of(self, x):
+        if type(x) is _Traced:
+            return self._values[x._index]
+        return x
+
+    def _apply(self, f, *args):
+        """Append a node computing f(*args) and return its stand-in.
+        f == None makes an input node holding args[0]."""
+        index = len(self._values)
+        if f is None:
+            value = args[0]
+        else:
+            value = f(*[self._value_of(a) for a in args])
+            for a in args:
+                if type(a) is _Traced:
+                    children = self._children[a._index]
+                    if not children or children[-1] != index:
+                        children.append(index)
+
+        self._fns.append(f)
+        self._args.append(args)
+        self._values.append(value)
+        self._children.append([])
+        return _Traced(self, index)
+
+    def _propagate(self, dirty):
+        # nodes are created in evaluation order, so always recomputing the
+        # lowest dirty index means every node sees up to date arguments
+        heap = list(set(dirty))
+        heapq.heapify(heap)
+        queued = set(heap)
+
+        fns, args, values, children = (
+            self._fns, self._args, self._values, self._children)
+        value_of = self._value_of
+        count = 0
+        while heap:
+            i = heapq.heappop(heap)
+            value = fns[i](*[value_of(a) for a in args[i]])
+            count += 1
+            if value != values[i]:
+                values[i] = value
+                for c in children[i]:
+                    if c not in queued:
+                        queued.add(c)
+                        heapq.heappush(heap, c)
+        self.recomputed = count
+
+
+class _Traced:
+    """Stand-in for a Dual while a Recording evaluates f."""
+
+    __slots__ = ('_rec', '_index')
+
+    def __init__(self, rec, index):
+        self._rec = rec
+        self._index = index
+
+    # Dual's operators read .real/.dual of their other operand, so a Dual
+    # constant inside f would otherwise build a Dual out of stand-ins
+    @property
+    def real(self):
+        raise TypeError('a Recording cannot trace operations on a Dual '
+                        'constant; use a plain number or make it an input')
+
+    dual = real
+
+    # comparisons would bake the branch taken at record time into the graph
+    def __eq__(self, y):
+        raise TypeError('a Recording cannot trace comparisons')
+
+    __ne__ = __eq__
+
+    def __bool__(self):
+        raise TypeError('a Recording cannot trace truth tests')
+
+    def __pos__(self):
+        return self
+
+    def __neg__(self):
+        return self._rec._apply(operator.neg, self)
+
+    def __abs__(self):
+        return self._rec._apply(abs, self)
+
+    def conj(self):
+        return self._rec._apply(Dual.conj, self)
+
+    def __add__(self, y):
+        return self._rec._apply(operator.add, self, y)
+
+    def __radd__(self, y):
+        return self._rec._apply(operator.add, y, self)
+
+    def __sub__(self, y):
+        return self._rec._apply(operator.sub, self, y)
+
+    def __rsub__(self, y):
+        return self._rec._apply(operator.sub, y, self)
+
+    def __mul__(self, y):
+        return self._rec._apply(operator.mul, self, y)
+
+    def __rmul__(self, y):
+        return self._rec._apply(operator.mul, y, self)
+
+    def __truediv__(self, y):
+        return self._rec._apply(operator.truediv, self, y)
+
+    def __rtruediv__(self, y):
+        return self._rec._apply(operator.truediv, y, self)
+
+    def __pow__(self, y):
+        return self._rec._apply(operator.pow, self, y)
+
+    def __rpow__(self, y):
+        return self._rec._apply(operator.pow, y, self)
+
+    def __repr__(self):
+        return f'<traced {self._rec._values[self._index]}>'
+
+
+def _record(f, *args):
+    """Called by the functions in this module when math rejects an argument.
+    Record f(*args) if an argument is a Recording stand-in, otherwise re-raise
+    the TypeError being handled."""
+    for a in args:
+        if type(a) is _Traced:
+            return a._rec._apply(f, *args)
+    raise
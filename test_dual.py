@@ -7,7 +7,7 @@ Created on Thu Dec  8 18:26:24 2022
 
 import math
 import dual
-from dual import Dual, sqrt, near_eq, sin, cos, tan, log, exp
+from dual import Dual, sqrt, near_eq, sin, cos, tan, log, exp, hypot
 import pytest
 
 
@@ -84,6 +84,93 @@ def test_pow():
                    ), f'{pow(Dual(9, 0.5), Dual(-0.333333333333333315, 0))} != Dual(0.480749856769136175, -0.00890277512535437437)'
 
 
+def test_pow_fast_paths():
+    # integer exponents, by repeated multiplication
+    assert Dual(3, 1)**2 == Dual(9, 6)
+    assert Dual(3, 1)**3 == Dual(27, 27)
+    assert Dual(-2, 1)**3 == Dual(-8, 12)
+    assert Dual(2, 1)**1 == Dual(2, 1)
+    assert near_eq(Dual(2, 1)**-2, Dual(0.25, -0.25))
+    assert near_eq(Dual(1.1, 0.5)**20, Dual(math.pow(1.1, 20), 0.5*20*math.pow(1.1, 19)))
+    assert near_eq(Dual(3, 1)**40, Dual(math.pow(3, 40), 40*math.pow(3, 39)),
+                   eps=1e6)
+    assert Dual(0, 1)**2 == Dual(0, 0)
+    assert Dual(0, 1)**1 == Dual(0, 1)
+    with pytest.raises((ValueError)):
+        Dual(0, 1)**-1
+    with pytest.raises((ValueError)):
+        Dual(0, 1)**0
+
+    # overflow and underflow as math.pow has them
+    assert near_eq(Dual(1e-10, 1)**-20, Dual(1e200, -2e211), eps=1e197)
+    assert Dual(1e200, 1)**-3 == Dual(0, 0)
+    for n in (2, 3, 4, 7, 2.0):
+        with pytest.raises((OverflowError)):
+            Dual(1e200, 1)**n
+    with pytest.raises((OverflowError)):
+        Dual(1e-200, 1)**-2
+    with pytest.raises((OverflowError)):
+        Dual(-1e-200, 1)**-3
+
+    # constant real exponents
+    assert near_eq(Dual(4, 1)**0.5, Dual(2, 0.25))
+    assert near_eq(Dual(4, 1)**0, Dual(1, 0))
+    assert Dual(0, 1)**2.5 == Dual(0, 0)
+    with pytest.raises((ValueError)):
+        Dual(-4, 1)**0.5
+    with pytest.raises((ValueError)):
+        Dual(0, 1)**0.5
+
+    # dual exponents keep the log term
+    assert near_eq(Dual(2, 1)**Dual(3, 1), Dual(8, 12 + 8*math.log(2)))
+    assert near_eq(Dual(-2, 1)**Dual(3, 1), Dual(-8, 12))
+    assert Dual(0, 1)**Dual(2, 1) == Dual(0, 0)
+    assert Dual(0, 1)**Dual(1, 1) == Dual(0, 1)
+
+
+class _Array:
+    """Minimal elementwise array, standing in for numpy."""
+
+    def __init__(self, values):
+        self.values = list(values)
+
+    def __mul__(self, y):
+        if isinstance(y, _Array):
+            return _Array(a * b for a, b in zip(self.values, y.values))
+        return _Array(a * y for a in self.values)
+
+    __rmul__ = __mul__
+
+    def __add__(self, y):
+        return _Array(a + y for a in self.values)
+
+    def __eq__(self, y):
+        return self.values == list(y)
+
+
+def test_pow_batched():
+    # integer exponents only use *, so array valued parts work elementwise,
+    # with the scalar results at 0
+    x = Dual(_Array([0., 1.5, -2.]), _Array([1., 1., 1.]))
+    for n in (1, 2, 3, 4, 5, 7, 2.0):
+        y = x**n
+        for a, v, d in zip(x.real.values, y.real.values, y.dual.values):
+            expected = Dual(a, 1)**n
+            assert near_eq(Dual(v, d), expected), (n, a)
+
+    # x**0 is 1 everywhere, including at 0 where a scalar base raises
+    y = x**0
+    assert y.real == [1, 1, 1]
+    assert y.dual == [0, 0, 0]
+
+
+def test_rpow():
+    assert near_eq(2**Dual(3, 1), Dual(8, 8*math.log(2)))
+    assert near_eq(3**Dual(2, 1), Dual(9, 9*math.log(3)))
+    assert near_eq(2**Dual(1, 2), Dual(2, 4*math.log(2)))
+    assert near_eq(math.e**Dual(1, 1), exp(Dual(1, 1)))
+
+
 def test_mul():
     assert near_eq((Dual(3, 0)*Dual(4, 0)), Dual(12, 0)
                    ), f'{(Dual(3, 0)*Dual(4, 0))} != Dual(12, 0)'
@@ -396,6 +483,255 @@ def test_exp():
         exp(Dual(709.196208642166084, 7))
 
 
+def test_reductions():
+    xs = [Dual(1, 2), Dual(3, -1), 4, Dual(0.5, 0.25)]
+    assert dual.sum(xs) == Dual(8.5, 1.25)
+    assert dual.sum(xs, compensated=True) == Dual(8.5, 1.25)
+    assert dual.sum([]) == Dual(0, 0)
+    with pytest.raises(TypeError):
+        dual.sum([1, 2], 10)
+    assert 'sum' not in dual.__all__
+
+    # fsum recovers what plain accumulation loses
+    xs = [Dual(1e100, 1), Dual(1, 1e100), Dual(-1e100, -1e100)]
+    assert dual.sum(xs) == Dual(0, 0)
+    assert dual.sum(xs, compensated=True) == Dual(1, 1)
+
+    xs = [Dual(1, 1), Dual(2, 0), 3]
+    ys = [Dual(4, 0), 5, Dual(6, 2)]
+    expected = Dual(1, 1)*Dual(4, 0) + Dual(2, 0)*5 + 3*Dual(6, 2)
+    assert dual.dot(xs, ys) == expected
+    assert dual.dot(xs, ys, compensated=True) == expected
+
+    xs = [Dual(2, 1), 3, Dual(-1, 2)]
+    assert dual.prod(xs) == Dual(2, 1)*3*Dual(-1, 2)
+    assert dual.prod([]) == Dual(1, 0)
+
+
+def test_polyval():
+    # x**2 + 5x + 6 and its derivative 2x + 5
+    assert dual.polyval([1, 5, 6], Dual(3, 1)) == Dual(30, 11)
+    assert dual.polyval([1, 5, 6], 3) == Dual(30, 0)
+    assert dual.polyval([], Dual(3, 1)) == Dual(0, 0)
+
+    x = Dual(1.5, 0.5)
+    p = [2, -3, Dual(0.5, 1), 7]
+    assert near_eq(dual.polyval(p, x), 2*x**3 - 3*x**2 + p[2]*x + 7)
+
+
+def test_recording():
+    def f(x, y, z):
+        return x*x + 3*sin(y) - exp(z)/2 + 1
+
+    rec = dual.Recording(f, Dual(2, 1), 0.5, 1.)
+    assert near_eq(rec.result, f(Dual(2, 1), Dual(0.5), Dual(1.)))
+    assert len(rec) == 11
+
+    # only sin(y), 3*sin(y) and the three sums after it depend on y
+    rec.update({1: 0.7})
+    assert rec.recomputed == 5
+    assert near_eq(rec.result, f(Dual(2, 1), Dual(0.7), Dual(1.)))
+
+    # unchanged inputs recompute nothing
+    rec.update({1: 0.7})
+    assert rec.recomputed == 0
+
+    # move the tangent from x to z
+    rec.seed(2)
+    assert near_eq(rec.result, f(Dual(2), Dual(0.7), Dual(1., 1)))
+    assert rec.inputs == [Dual(2, 0), Dual(0.7, 0), Dual(1, 1)]
+
+    rec.seed([1, 1, 0])
+    assert near_eq(rec.result, f(Dual(2, 1), Dual(0.7, 1), Dual(1.)))
+
+    with pytest.raises(IndexError):
+        rec.update({3: 1.})
+    with pytest.raises(ValueError):
+        rec.seed([1, 0])
+    with pytest.raises(IndexError):
+        rec.seed(-1)
+    with pytest.raises(IndexError):
+        rec.seed(3)
+
+
+def test_recording_reductions():
+    def f(a, b, c):
+        xs = [a, b, c]
+        return (dual.sum(x*x for x in xs),
+                dual.sum([1., a, 2*b], compensated=True),
+                dual.dot([2., 3., c], xs),
+                dual.dot([2., b], [a, 3.], compensated=True),
+                dual.prod([2, a, b]),
+                dual.polyval([1, 5, 6], a),
+                dual.polyval([2., b, 1.], 3.))
+
+    inputs = [Dual(1, 1), 2., 3.]
+    rec = dual.Recording(f, *inputs)
+    for got, expected in zip(rec.result, f(*inputs)):
+        assert near_eq(got, expected)
+
+    rec.update({1: Dual(-2, 1)})
+    for got, expected in zip(rec.result, f(Dual(1, 1), Dual(-2, 1), 3.)):
+        assert near_eq(got, expected)
+
+    # each reduction is one node: the six using b are recomputed, plus the
+    # b*b and 2*b feeding two of them, but not polyval([1, 5, 6], a)
+    assert rec.recomputed == 8
+
+
+def test_recording_comparisons():
+    for f in (lambda x: x if x == 3 else -x,
+              lambda x: x if x != 3 else -x,
+              lambda x: x if x else -x,
+              lambda x: x if x > 0 else -x):
+        with pytest.raises(TypeError):
+            dual.Recording(f, 3.)
+
+
+def test_recording_dual_constant():
+    for f in (lambda x: Dual(2, 1) * x,
+              lambda x: Dual(2, 1) + x,
+              lambda x: Dual(2, 1) / x,
+              lambda x: hypot(Dual(2, 1), x)):
+        with pytest.raises(TypeError):
+            dual.Recording(f, 3.)
+
+    # on the right of a recorded value a Dual constant is an ordinary argument
+    rec = dual.Recording(lambda x: x * Dual(2, 1), Dual(3, 1))
+    assert rec.result == Dual(6, 5)
+
+
+def test_recording_early_cutoff():
+    # abs(x) does not change when x changes sign, so nothing after it is
+    # recomputed
+    rec = dual.Recording(lambda x, y: sqrt(abs(x)) * y, 4., Dual(1, 1))
+    assert rec.result == Dual(2, 2)
+    rec.update({0: -4.})
+    assert rec.recomputed == 1
+    assert rec.result == Dual(2, 2)
+
+    rec = dual.Recording(lambda x, y: (x + y, x * y), 2., 3.)
+    rec.update({0: Dual(5, 1)})
+    assert rec.result == (Dual(8, 1), Dual(15, 3))
+    assert rec.recomputed == 2
+
+
+def test_least_squares():
+    ts = [0.1 * i for i in range(30)]
+    ys = [3 * math.exp(-0.7 * t) + 0.5 for t in ts]
+
+    def residuals(p):
+        return [p[0] * exp(p[1] * t) + p[2] - y for t, y in zip(ts, ys)]
+
+    fit = dual.least_squares(residuals, [1., -0.1, 0.])
+    assert fit.converged
+    assert fit.message in ('gradient below gtol', 'step below xtol',
+                           'cost decrease below ftol')
+    assert all(abs(a - b) < 1e-8 for a, b in zip(fit.x, [3, -0.7, 0.5]))
+    assert fit.cost < 1e-20
+    assert len(fit.jacobian) == len(ts)
+    assert near_eq(Dual(fit.jacobian[5][1]), Dual(fit.x[0] * ts[5] * math.exp(fit.x[1] * ts[5])), 1e-8)
+    assert fit.evaluations == 1 + sum(h.evaluations for h in fit.history) + 3
+    assert all(h.seconds >= 0 for h in fit.history)
+
+
+def test_least_squares_stalled():
+    # Gauss-Newton steps cannot get past the kink at 0, so the damping grows
+    # until it gives up far from the minimum
+    for residuals in (lambda p: [sqrt(abs(p[0]))],
+                      lambda p: [abs(p[0]) + 1]):
+        fit = dual.least_squares(residuals, [1.])
+        assert not fit.converged
+        assert fit.message.startswith('damping stalled')
+
+    fit = dual.least_squares(lambda p: [exp(p[0]) - 2], [5.], max_iter=2)
+    assert not fit.converged
+    assert fit.message.startswith('max_iter')
+    assert len(fit.history) == 2
+
+
+def test_least_squares_large_damping():
+    # damping beyond the stall limit still accepts steps that lower the cost
+    fit = dual.least_squares(lambda p: [p[0] - 1], [0.], damping=1.5e16)
+    assert fit.x[0] > 0
+    assert fit.cost < 0.5
+    assert not fit.message.startswith('damping stalled')
+
+
+def test_least_squares_sparse():
+    # discretized u'' + exp(u) = 0, u(0) = u(1) = 0: each residual depends
+    # on three neighbouring parameters
+    n = 20
+    h2 = 1 / (n + 1)**2
+
+    def residuals(u):
+        return [(u[i-1] if i > 0 else 0) - 2*u[i] + (u[i+1] if i < n-1 else 0)
+                + h2 * exp(u[i]) for i in range(n)]
+
+    sparsity = [[j for j in (i-1, i, i+1) if 0 <= j < n] for i in range(n)]
+    dense = dual.least_squares(residuals, [0.] * n)
+    sparse = dual.least_squares(residuals, [0.] * n, sparsity=sparsity)
+    assert sparse.converged
+    assert sparse.cost < 1e-20
+    assert sparse.x == dense.x
+    assert sparse.jacobian == dense.jacobian
+
+    # the Jacobian takes three passes instead of n
+    jacobian_passes = sparse.evaluations - 1 - sum(h.evaluations for h in sparse.history)
+    assert jacobian_passes == 3
+
+    with pytest.raises(ValueError):
+        dual.least_squares(residuals, [0.] * n, sparsity=sparsity[1:])
+
+
+def test_fixed_point():
+    # x = cos(x)/2 + p, so dx/dp = 1 / (1 + sin(x)/2)
+    x = dual.fixed_point(lambda x, p: 0.5*cos(x) + p, 0., Dual(1, 1))
+    assert abs(x.real - (0.5*math.cos(x.real) + 1)) < 1e-12
+    assert near_eq(x, Dual(x.real, 1 / (1 + 0.5*math.sin(x.real))))
+
+    # same answer as propagating the Dual through every iteration
+    y = Dual(0.)
+    for _ in range(200):
+        y = 0.5*cos(y) + Dual(1, 1)
+    assert near_eq(x, y, 1e-11)
+
+    # x = A x + p, so x = (I - A)^-1 p
+    def g(x, p):
+        return [0.5*x[0] + 0.25*x[1] + p[0], 0.25*x[0] + p[1]]
+    x = dual.fixed_point(g, [0., 0.], [Dual(1, 1), 2.])
+    assert near_eq(x[0], Dual(24/7, 16/7), 1e-10)
+    assert near_eq(x[1], Dual(20/7, 4/7), 1e-10)
+
+    with pytest.raises(RuntimeError):
+        dual.fixed_point(lambda x, p: 2*x + p, 1., 1., max_iter=20)
+
+
+def test_implicit_root():
+    # x**3 = p, so dx/dp = 1 / (3 x**2)
+    assert near_eq(dual.implicit_root(lambda x, p: x**3 - p, 1., Dual(8, 1)),
+                   Dual(2, 1/12))
+    assert dual.implicit_root(lambda x, p: x**3 - p, 1., 8) == Dual(2, 0)
+
+    def F(x, p):
+        return [x[0] + x[1] - p[0], x[0] - x[1] - p[1]]
+    x = dual.implicit_root(F, [0., 0.], [Dual(3, 1), Dual(1, 0)])
+    assert near_eq(x[0], Dual(2, 0.5))
+    assert near_eq(x[1], Dual(1, 0.5))
+
+    # the root moves with p along sqrt(p)
+    x = dual.implicit_root(lambda x, p: x*x - p[0], 3., [Dual(2, 1)])
+    assert near_eq(x, sqrt(Dual(2, 1)))
+
+    with pytest.raises(RuntimeError):
+        dual.implicit_root(lambda x, p: exp(x) + p, 1., 1., max_iter=3)
+
+    # converging on the last allowed step is not a failure
+    assert dual.implicit_root(lambda x, p: x - p, 0., Dual(2, 1), max_iter=1) == Dual(2, 1)
+    with pytest.raises(RuntimeError):
+        dual.implicit_root(lambda x, p: x - p, 0., Dual(2, 1), max_iter=0)
+
+
 def _test_functional():
 
     def f(x): return x